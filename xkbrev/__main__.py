@@ -1,11 +1,14 @@
 # Copyright (C) 2020 Roland Kaufmann
 
 import argparse
+import codecs
 import collections as col
+import concurrent.futures as fut
+import contextlib
 import enum
-import functools as fun
+import hashlib
+import itertools as itt
 import logging
-import operator as op
 import os
 import os.path as path
 import re
@@ -20,104 +23,310 @@ log = logging.getLogger(__name__)  #pylint: disable=invalid-name
 log.addHandler(logging.NullHandler())
 
 
-# pattern to recognize the xkb_symbols output from setxkbmap
-SYMBOLS_PAT = re.compile(r'\txkb_symbols\s*{\sinclude\s\"(.*)\"\s*};')
+# pattern to recognize the xkb_symbols output from setxkbmap; the output is
+# read as bytes, and only the layout description is decoded
+SYMBOLS_PAT = re.compile(rb'\txkb_symbols\s*{\sinclude\s\"(.*)\"\s*};')
+
+# the geometry is declared after the symbols, so the scan can stop there
+GEOMETRY_HEAD = b'\txkb_geometry'
+
+# standard parts that are typically added to the symbols of every layout
+IGNORED_PARTS = frozenset(['pc', 'inet(evdev)'])
 
 def identify_layout(f):
     """\
     Determine which keyboard layout an input specification is for.
+
+    :param f: Iterator over the (binary) lines of output from setxkbmap
     """
     log.info("Parsing setxkbmap output")
-    f.seek(os.SEEK_SET, 0)
-    while True:
-        line = f.readline()
-
-        # exit the loop if we get end-of-file
-        if len(line) == 0:
-            break
-
+    for line in f:
         # if we find a match, then return this right away
-        m = re.match(SYMBOLS_PAT, line)
+        m = SYMBOLS_PAT.match(line)
         if m is not None:
-            parts = m.group(1).split("+")
             # filter out standard parts that are typically added
-            parts = list(filter(lambda x: x != "pc", parts))
-            parts = list(filter(lambda x: x != "inet(evdev)", parts))
+            parts = [p for p in m.group(1).decode().split("+")
+                     if p not in IGNORED_PARTS]
             layout = "+".join(parts)
             log.debug("Found an xkb_symbols line")
             return layout
+        if line.startswith(GEOMETRY_HEAD):
+            break
 
-    # this indicates that we read through the entire output, but didn't
-    # get any match; setxkbmap didn't return a proper result
+    # this indicates that we read through the output, but didn't get any
+    # match; setxkbmap didn't return a proper result
     log.warning("Did not find an xkb_symbols line")
     return None
 
 
-def compile_layout(layout, variant, options):
+# size of the blocks that the output of the compiler is read and decoded in
+BLOCK_SIZE = 64 * 1024
+
+
+def decode_lines(f, copy=None):
     """\
-    :param layout:  Name of the layout, e.g. "us"
-    :param variant: Variant, e.g. "dvorak", or None
-    :param options: List of options to apply
+    Read output from a program in blocks, decode each block as a whole, and
+    split it into lines (without trailing whitespace).
+
+    :param f:    Binary file that the output is read from
+    :param copy: New copy of the cache that receives everything that is
+                 read, or None
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    partial = ''
+    while True:
+        block = f.read1(BLOCK_SIZE)
+        if len(block) == 0:
+            break
+        if copy is not None:
+            write_cache(copy, block)
+        # the last line of the block continues in the next one
+        lines = (partial + decoder.decode(block)).split('\n')
+        partial = lines.pop()
+        yield from map(str.rstrip, lines)
+    partial += decoder.decode(b'', final=True)
+    if len(partial) > 0:
+        yield partial.rstrip()
+
+
+def feed_compiler(keymap, outf):
+    """\
+    Write the output from setxkbmap to the input of xkbcomp.
+
+    :param keymap: Output of setxkbmap
+    :param outf:   Input pipe of the compiler; closed when all is written
+    """
+    try:
+        with outf:
+            outf.write(keymap)
+    except BrokenPipeError:
+        # the compiler stopped reading; it will report this by itself
+        pass
+
+
+# directory of the keyboard layout database that layouts are compiled from
+XKB_DIR = '/usr/share/X11/xkb'
+
+
+def raise_error(err):
+    """\
+    Raise an error that is reported through a callback, e.g. from os.walk.
+    """
+    raise err
+
+
+def cache_file_name(keymap, compiler):
+    """\
+    Get the name of the file that caches the compiled source of a keymap.
+
+    :param keymap:   Output of setxkbmap that is compiled
+    :param compiler: Path of the program that compiles it
+    :return:         Name of the file, or None if the database cannot be read
+    """
+    cache_dir = (os.environ.get('XDG_CACHE_HOME') or
+                 path.join(path.expanduser('~'), '.cache'))
+    digest = hashlib.sha256(keymap)
+    # the compiled source also depends on the version of the compiler, and on
+    # the files that the keymap includes; updates of the database replace
+    # files in its (nested) subdirectories, which changes the modification
+    # time of the directory they are in
+    try:
+        digest.update(b'%d' % os.stat(compiler).st_mtime_ns)
+        for dir_name, subdirs, _ in os.walk(XKB_DIR, onerror=raise_error):
+            subdirs.sort()
+            digest.update(b'%d' % os.stat(dir_name).st_mtime_ns)
+    except OSError as err:
+        log.info("Not caching compiled layout: %s", err)
+        return None
+    return path.join(cache_dir, 'xkbrev', digest.hexdigest()[:16] + '.txt')
+
+
+def open_cache(name):
+    """\
+    Open a temporary file next to the cache file, to write a new copy into.
+
+    :return: Temporary file, or None if the cache cannot be written
+    """
+    try:
+        os.makedirs(path.dirname(name), exist_ok=True)
+        return tempfile.NamedTemporaryFile(mode='w+b', dir=path.dirname(name),
+                                           delete=False)
+    except OSError as err:
+        log.info("Not caching compiled layout: %s", err)
+        return None
+
+
+def write_cache(f, data):
+    """\
+    Write to a new copy of the cache. The cache is only an aid, so if this
+    fails, then the copy is discarded, and later writes to it are ignored.
+    """
+    if f.closed:
+        return
+    try:
+        f.write(data)
+    except OSError as err:
+        log.info("Not caching compiled layout: %s", err)
+        discard_cache(f)
+
+
+def discard_cache(f):
+    """\
+    Close a new copy of the cache and remove it, leaving the cache file as
+    it was.
+    """
+    with contextlib.suppress(OSError):
+        f.close()
+    with contextlib.suppress(OSError):
+        os.remove(f.name)
+
+
+def store_cache(f, name, complete):
+    """\
+    Close a new copy of the cache, and replace the cache file with it if the
+    output was complete, otherwise discard it.
+    """
+    # the copy has already been discarded if writing to it failed
+    if f.closed:
+        return
+    try:
+        f.close()
+        if complete:
+            os.replace(f.name, name)
+            return
+    except OSError as err:
+        log.info("Not caching compiled layout: %s", err)
+    discard_cache(f)
+
+
+def compile_layout(layout, variant, options, use_cache=True):
+    """\
+    :param layout:    Name of the layout, e.g. "us"
+    :param variant:   Variant, e.g. "dvorak", or None
+    :param options:   List of options to apply
+    :param use_cache: Reuse the previous output for the same keymap, if the
+                      database hasn't changed since
     """
     # create list of arguments to pass to setxkbmap, which will prepare a
     # full keyboard definitions for us
     setxkbmap_prog = '/usr/bin/setxkbmap'
     layout_args = ['-layout', layout] if layout is not None else []
     variant_args = ['-variant', variant] if variant is not None else []
-    opt_args = (fun.reduce(op.concat, map(lambda x: ['-option', x], options))
+    opt_args = ([arg for opt in options for arg in ['-option', opt]]
                 if options is not None else [])
     setxkbmap_cmdline = ([setxkbmap_prog] + layout_args + variant_args +
                          opt_args + ['-print'])
+    xkbcomp_prog = '/usr/bin/xkbcomp'
+    xkbcomp_cmdline = [xkbcomp_prog, '-w', '0', '-C', '-', '-o', '-']
+
+    # setxkbmap is always run, since what it prints also depends on the
+    # current settings of the display, such as the model and the rules. the
+    # output is only a few include lines, so it is read all at once
+    with subprocess.Popen(setxkbmap_cmdline,
+                          stdout=subprocess.PIPE) as setxkbmap:
+        keymap = setxkbmap.stdout.read()
+    if setxkbmap.returncode != 0:
+        raise subprocess.CalledProcessError(setxkbmap.returncode,
+                                            setxkbmap_cmdline)
+    layout_descr = identify_layout(keymap.splitlines())
+    if layout_descr is not None:
+        log.info("Layout: %s", layout_descr)
+
+    # if this keymap has been compiled before, then read it from the cache
+    # instead of running the compiler again
+    cache_name = cache_file_name(keymap, xkbcomp_prog) if use_cache else None
+    if cache_name is not None and path.exists(cache_name):
+        log.info("Using cached layout: %s", cache_name)
+        with open(cache_name, 'rb') as f:
+            yield from decode_lines(f)
+        return
+
+    # the output of the compiler is read through a pipe, instead of going
+    # through a temporary file. the pipe is binary, and is decoded in blocks
+    with subprocess.Popen(xkbcomp_cmdline, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE) as xkbcomp, \
+         fut.ThreadPoolExecutor(max_workers=1) as executor:
+
+        # write the input of the compiler in the background, so that we
+        # can start parsing the output as soon as it is available
+        feeder = executor.submit(feed_compiler, keymap, xkbcomp.stdin)
+        cache = None
+        try:
+            # keep a copy of the output, to use instead of running the
+            # compiler again next time
+            if cache_name is not None:
+                cache = open_cache(cache_name)
+
+            # read every line from the output and yield it
+            yield from decode_lines(xkbcomp.stdout, cache)
+        finally:
+            # the parser stops before the end, so read the rest of the output
+            # to let the compiler finish instead of failing on a closed
+            # pipe; the cache must have a copy of all of it
+            rest = xkbcomp.stdout.read()
+            xkbcomp.stdout.close()
+            if cache is not None:
+                write_cache(cache, rest)
+                store_cache(cache, cache_name, xkbcomp.wait() == 0)
+            # any error in writing the input is raised here
+            feeder.result()
+            if xkbcomp.wait() != 0:
+                raise subprocess.CalledProcessError(xkbcomp.returncode,
+                                                    xkbcomp_cmdline)
+
+
+class PushbackIter:
+    """\
+    Iterator that lets the reader put back lines it has read too far, so that
+    they are returned again by the next call.
+    """
+    __slots__ = ('it', 'buf')
+
+    def __init__(self, it):
+        self.it = iter(it)
+        self.buf = []
+
+    def __iter__(self):
+        return self
 
-    # output file will stay open until we are done parsing it
-    with tempfile.TemporaryFile(mode='w+t') as outfile:
-
-        # input file to xkbcomp is the output of setxkbmap; first
-        with tempfile.TemporaryFile(mode='w+t') as infile:
-            subprocess.call(setxkbmap_cmdline, stdout=infile.fileno())
-            # retrieve description of the layout
-            layout_descr = identify_layout(infile)
-            if layout_descr is not None:
-                log.info("Layout: %s", layout_descr)
-            # start over again as we feed it to the compiler
-            infile.seek(os.SEEK_SET, 0)
-            xkbcomp_prog = '/usr/bin/xkbcomp'
-            xkbcomp_cmdline = [xkbcomp_prog, '-w', '0', '-C', '-', '-o', '-']
-            subprocess.call(xkbcomp_cmdline,
-                            stdin=infile.fileno(),
-                            stdout=outfile.fileno())
-
-        # read every line from the output and yield it; when we have been
-        # through all the lines, the file will close and automatically be
-        # deleted (since it is temporary)
-        outfile.seek(os.SEEK_SET, 0)
-        while True:
-            line = outfile.readline()
-            if len(line) == 0:
-                break
-            else:
-                # if someone sends a True value into the generator, then repeat
-                # the previous line one more time
-                stripped = line.rstrip()
-                again = yield(stripped)
-                if again:
-                    # the first value is yielded to the 'send' function
-                    yield None
-                    yield stripped
-
-
-# pattern to recognize the declaration of the number of keys
-NUMKEY_PAT = re.compile(r'^#define NUM_KEYS\s+([0-9]+)')
+    def __next__(self):
+        return self.buf.pop() if self.buf else next(self.it)
+
+    def push(self, item):
+        """\
+        Put an item back, so that it is the next one to be returned.
+        """
+        self.buf.append(item)
+
+
+def read_section(source_line):
+    """\
+    Read the lines up to the end of a declaration, and return them as a single
+    string, so that the entries in it can be scanned in one go.
+    """
+    lines = []
+    for line in source_line:
+        if line == '};':
+            break
+        lines.append(line)
+    return ''.join(lines)
+
+
+# start of the declaration of the number of keys
+NUMKEY_HEAD = '#define NUM_KEYS'
 
 def read_num_keys(source_line):
     """\
     Read the number of virtual keys defined in the layout
     """
-    while True:
-        line = next(source_line, None)
-        m = re.match(NUMKEY_PAT, line)
-        if m is not None:
-            number = int(m.group(1))
+    for line in source_line:
+        if not line.startswith(NUMKEY_HEAD):
+            continue
+        # the declaration is the directive, the name and then the number;
+        # other names may start with the same text, so check it exactly
+        fields = line.split()
+        if fields[1] == 'NUM_KEYS' and len(fields) > 2:
+            number = int(fields[2])
             log.info("Number of keys: %d", number)
             return number
     return None
@@ -126,28 +335,24 @@ def read_num_keys(source_line):
 # header for keyname section
 KEYNAME_HEAD = 'static XkbKeyNameRec	keyNames[NUM_KEYS]= {'
 
-# pattern for declaration of a key name
-KEYNAME_PAT = re.compile(r'\s{4}{\s+\"([A-Z0-9_\+\-]*)\"\s{2}}(,?)')
-
 def read_key_names(num_keys, source_line):
     """\
     Read the names of the keys, return an array with them
     """
-    # preallocate the array
-    key_names = ['']*num_keys
-    i = 0
-    while True:
-        line = next(source_line, None)
+    key_names = []
+    for line in source_line:
         if line.startswith(KEYNAME_HEAD):
-            while line != '};':
-                for m in re.finditer(KEYNAME_PAT, line):
-                    name = m.group(1)
-                    key_names[i] = name
-                    i += 1
-                line = next(source_line, None)
+            # each entry is a name in quotes, and nothing else in the section
+            # is quoted, so every other part between quotes is a name. names
+            # are interned since they are used as keys in the layout map and
+            # compared to the names from the keycode definitions
+            key_names = list(map(sys.intern,
+                                 read_section(source_line).split('"')[1::2]))
             break
     # verify that we read exactly the number of keys expected
-    log.info('Read %d key names', i)
+    log.info('Read %d key names', len(key_names))
+    if len(key_names) != num_keys:
+        log.warning("Expected %s key names", num_keys)
     return key_names
 
 
@@ -184,12 +389,37 @@ MOD_NAME_TO_ENUM = {
 }
 
 
+# modifier names with and without the prefix for virtual modifiers and the
+# suffix for masks, as they appear in the activation maps, mapped directly to
+# the bit of the modifier; the normal state is not a modifier, and has no bit
+MOD_LOOKUP = {prefix + name + suffix: mod.value
+              for name, mod in MOD_NAME_TO_ENUM.items()
+              for prefix in ['', 'vmod_']
+              for suffix in ['', 'Mask']}
+MOD_LOOKUP['0'] = 0
+
+
+def mod_names(mask):
+    """\
+    Get the names of the modifiers which are in a bitmask, for display.
+    """
+    return [mod.name for mod in Modifier if mask & mod.value]
+
+
 # key type definitions start with this line; this also ends modifier maps
 KEYTYPE_HEAD = 'static XkbKeyTypeRec dflt_types[]= {'
 
-# header that introduces each activation map, and pattern for each line in it
-ACT_HEAD_PAT = r'static XkbKTMapEntryRec map_([A-Z0-9_]+)\[([0-9]+)\]= {'
-ACT_REC_PAT = r'\s+{\s*([01]),\s*([0-9]+),\s*{\s*(.*),\s*(.*),\s*(.*)\s}\s},?'
+# header that introduces each activation map, and pattern for each line in it;
+# only lines with the start of the header are matched against the pattern.
+# the records of a map are scanned together, so whitespace in the pattern for
+# them must not go past the end of a line
+ACT_HEAD_START = 'static XkbKTMapEntryRec map_'
+ACT_HEAD_PAT = re.compile(
+    r'static XkbKTMapEntryRec map_([A-Z0-9_]+)\[([0-9]+)\]= {')
+ACT_REC_PAT = re.compile(
+    r'^[ \t]+{[ \t]*([01]),[ \t]*([0-9]+),' +
+    r'[ \t]*{[ \t]*(.*),[ \t]*(.*),[ \t]*(.*)[ \t]}[ \t]},?',
+    re.MULTILINE)
 
 def read_activation_map(source_line):
     """\
@@ -200,16 +430,17 @@ def read_activation_map(source_line):
     """
     # there is always a default 'ONE_LEVEL', with a level that is activated
     # regardless of any modifiers
-    act_map = {'ONE_LEVEL': {frozenset(): 0}}
-    while True:
-        line = next(source_line, None)
+    act_map = {'ONE_LEVEL': {0: 0}}
+    for line in source_line:
         # type entries go on until this line appears
         if line.startswith(KEYTYPE_HEAD):
-            # ask the iterator to unget the last line
-            source_line.send(True)
+            # put the line back for the reader of the key types
+            source_line.push(line)
             break
         # if we find a map record, the start parsing its entries
-        m = re.match(ACT_HEAD_PAT, line)
+        if not line.startswith(ACT_HEAD_START):
+            continue
+        m = ACT_HEAD_PAT.match(line)
         if m is not None:
             # the number of lines are specified in the declaration
             map_name = m.group(1)
@@ -217,39 +448,30 @@ def read_activation_map(source_line):
             log.debug("Key type %s contains %d activations", map_name, num_rec)
             # pre-allocate an empty activation record; no modifiers always
             # activates the first level declared
-            act_rec = {frozenset(): 0}
-            # read each activation record
-            for i in range(num_rec):
-                line = next(source_line, None)
-                m = re.match(ACT_REC_PAT, line)
-                if m is None:
-                    log.fatal("Map entry does not match expected pattern")
-                    log.fatal("%s", line)
-                    break
-                # first column indicates if this level determines shift
-                shift = bool(m.group(1))
-                # second column is the level this combination controls
-                level = int(m.group(2))
-                # third column is the modifiers that applies to this level
-                mods = m.group(3).split('|')
-                # fourth column should be the same as third in the
-                # auto-generated files
-                if m.group(4) != m.group(3):
+            act_rec = {0: 0}
+            # read all the activation records, and scan them in one go
+            block = '\n'.join(itt.islice(source_line, num_rec))
+            records = ACT_REC_PAT.findall(block)
+            if len(records) != num_rec:
+                log.fatal("Map entry does not match expected pattern")
+                log.fatal("%s", block)
+            # first column indicates if this level determines shift, second
+            # column is the level this combination controls, third column is
+            # the modifiers that applies to this level, fourth column should be
+            # the same as third in the auto-generated files, and fifth column
+            # is additional modifiers
+            for shift, level, mask, real_mods, vmods in records:
+                level = int(level)
+                if real_mods != mask:
                     log.warning("Unexpected modifier declaration")
-                # fifth column is additional modifiers
-                mods.extend(m.group(5).split('|'))
-                # remove both prefix and suffix from modifiers
-                mods = [m[len('vmod_'):] if m.startswith('vmod_') else m
-                        for m in mods]
-                mods = [m[:-len('Mask')] if m.endswith('Mask') else m
-                        for m in mods]
-                # normal state is not a modifier
-                mods = list(filter(lambda x: x != '0', mods))
-                # map to modifier enum
-                mods = [MOD_NAME_TO_ENUM[m] for m in mods]
-                log.debug("Level %d is activated on modifiers %s", level,
-                          ', '.join([m.name for m in mods]))
-                act_rec[frozenset(mods)] = level
+                # combine the modifiers to a bitmask
+                mods = 0
+                for raw in mask.split('|') + vmods.split('|'):
+                    mods |= MOD_LOOKUP[raw]
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Level %d is activated on modifiers %s", level,
+                              ', '.join(mod_names(mods)))
+                act_rec[mods] = level
 
             # create a set of activation records for this map
             act_map[map_name] = act_rec
@@ -263,23 +485,24 @@ def read_activation_map(source_line):
     return act_map
 
 
+# name of a key type, and the number of levels that it has
+KeyType = col.namedtuple('KeyType', ['name', 'levels'])
+
 def read_key_types(source_line):
     """\
     Create a list of which key type index that has which name
     """
     key_types = []
     # discard source lines until we arrive at our header line
-    while True:
-        line = next(source_line, None)
+    for line in source_line:
         if line == KEYTYPE_HEAD:
             break
 
     # now read the list of types
-    while True:
+    for line in source_line:
         # each type consists of six lines: first line is just an opening brace,
         # unless it is the end of the map (the actual number of entries is not
         # defined as a readily available number, so we build a dynamic list)
-        line = next(source_line, None)
         if line == '};':
             break
         if line != '    {':
@@ -309,7 +532,7 @@ def read_key_types(source_line):
         if not line.startswith('    }'):
             log.fatal('Parsing error: Expected closing brace')
         # build an entry for this type and put in the list
-        key_types.append({'name': map_name, 'levels': num_levels})
+        key_types.append(KeyType(map_name, num_levels))
 
     # this is a list that contains the name of each type, in the position that
     # is used as 'key index' in the symbol table
@@ -327,8 +550,7 @@ def read_symbol_list(source_line):
     there is an index array that tells where one ends and the next starts.
     """
     # discard source lines until we arrive at our header line
-    while True:
-        line = next(source_line, None)
+    for line in source_line:
         if line.startswith(SYMBOLS_HEAD):
             break
 
@@ -336,8 +558,7 @@ def read_symbol_list(source_line):
     symbols = []
 
     # now read the list of symbols until the list ends
-    while True:
-        line = next(source_line, None)
+    for line in source_line:
         if line == '};':
             break
 
@@ -345,11 +566,8 @@ def read_symbol_list(source_line):
         # whitespace and the XK_ prefix (which are identifiers in the C code)
         sym_list = line.strip()
         sym_list = sym_list[:-1] if sym_list.endswith(',') else sym_list
-        sym_list = sym_list.split(',')
-        sym_list = [s.strip() for s in sym_list]
-        sym_list = [s[len('XK_'):] if s.startswith('XK_') else s
-                    for s in sym_list]
-        symbols.extend(sym_list)
+        symbols.extend(s[len('XK_'):] if s.startswith('XK_') else s
+                       for s in map(str.strip, sym_list.split(',')))
 
     log.info('Read %d symbols', len(symbols))
     return symbols
@@ -357,7 +575,11 @@ def read_symbol_list(source_line):
 
 # header and entry for each of the symbol triplets
 SYMMAP_HEAD = 'static XkbSymMapRec\tsymMap[NUM_KEYS]= {'
-SYMMAP_PAT = r'\s*{\s*([0-9]+),\s*0x([01]),\s*([0-9]+)\s*},?'
+SYMMAP_PAT = re.compile(r'\s*{\s*([0-9]+),\s*0x([01]),\s*([0-9]+)\s*},?')
+
+# index of the key type, whether the key is defined, and the offset of its
+# symbols in the flat symbol list
+KeyDef = col.namedtuple('KeyDef', ['type', 'defined', 'offset'])
 
 
 def read_key_map(source_line):
@@ -366,35 +588,25 @@ def read_key_map(source_line):
     position in the flat symbol list
     """
     # discard source lines until we arrive at our header line
-    while True:
-        line = next(source_line, None)
+    for line in source_line:
         if line.startswith(SYMMAP_HEAD):
             break
 
     key_map = []
 
     # read key mapping until we read the end symbol of the list
-    while True:
-        line = next(source_line, None)
-        if line == '};':
-            break
-
-        for m in re.finditer(SYMMAP_PAT, line):
-            # first item in the key type index
-            type_index = int(m.group(1))
-            # second item is the number of groups; note that we only support
-            # zero or one groups; we don't have any code to handle more than one
-            # group for the time being
-            num_groups = int(m.group(2))
-            # third item is the offset in the flat symbols list
-            offset = int(m.group(3))
-
-            # create an entry for this key
-            key_map.append({
-                'type': type_index,
-                'defined': num_groups > 0,
-                'offset': offset
-            })
+    for m in SYMMAP_PAT.finditer(read_section(source_line)):
+        # first item in the key type index
+        type_index = int(m.group(1))
+        # second item is the number of groups; note that we only support
+        # zero or one groups; we don't have any code to handle more than one
+        # group for the time being
+        num_groups = int(m.group(2))
+        # third item is the offset in the flat symbols list
+        offset = int(m.group(3))
+
+        # create an entry for this key
+        key_map.append(KeyDef(type_index, num_groups > 0, offset))
 
     return key_map
 
@@ -403,11 +615,12 @@ def read_layout_map(source):
     """\
     Read layout map from layout source code.
 
-    :param source_line: Generator that returns each line of source code.
+    :param source_line: Iterator that returns each line of source code, and
+                        which lines can be pushed back into.
 
     :return: Dictionary indexed by virtual key name, containing a new dictionary
-             indexed by a (frozen) set of modifiers, containing the symbol that
-             is generated for this particular combination of key and modifiers.
+             indexed by a bitmask of modifiers, containing the symbol that is
+             generated for this particular combination of key and modifiers.
     """
     num_keys = read_num_keys(source)
     key_names = read_key_names(num_keys, source)
@@ -422,7 +635,7 @@ def read_layout_map(source):
     for ndx, keydef in enumerate(key_map):
         # if there is no definition of this key, then we don't add it to the
         # final dictionary
-        if not keydef['defined']:
+        if not keydef.defined:
             continue
 
         # get the virtual, scancode-independent name of the _key_ (not the
@@ -430,21 +643,19 @@ def read_layout_map(source):
         virt_key = key_names[ndx]
 
         # get the type that is designated for this particular key
-        t = key_types[keydef['type']]
+        t = key_types[keydef.type]
 
         # this is the offset into the flat symbols list where the levels for
         # this particular key starts
-        ofs = keydef['offset']
+        ofs = keydef.offset
 
         # build a list of level-to-symbol for this particular key
-        sym = [''] * t['levels']
-        for level in range(t['levels']):
-            sym[level] = symbols[ofs + level]
+        sym = symbols[ofs:ofs + t.levels]
 
         # generate an entry for each activation combination of modifiers for
         # this particular type
         sym_for_mods = {}
-        for _, (mods, level) in enumerate(act_map[t['name']].items()):
+        for _, (mods, level) in enumerate(act_map[t.name].items()):
             sym_for_mods[mods] = sym[level]
 
         # add to the global map for this particular virtual key
@@ -453,9 +664,12 @@ def read_layout_map(source):
     return layout_map
 
 
-# header file definition of a named key symbol
-SYMDEF_PAT = re.compile(r'^#define\sXK_([A-Za-z_0-9]+)\s+0x0*([A-Fa-f0-9]+)' +
-                        r'(\s\s\/\* U\+0*([A-Fa-f0-9]+)\s.*)?.*$')
+# header file definition of a named key symbol; the whole file is scanned at
+# once, so whitespace is restricted to not go past the end of the line
+SYMDEF_PAT = re.compile(r'^#define[ \t]XK_([A-Za-z_0-9]+)' +
+                        r'[ \t]+0x0*([A-Fa-f0-9]+)' +
+                        r'(?:[ \t]{2}/\* U\+0*([A-Fa-f0-9]+)\s)?',
+                        re.MULTILINE)
 
 
 def read_symbol_map():
@@ -468,26 +682,19 @@ def read_symbol_map():
     # read symbols from this (hardcoded) file; the key symbols always mean the
     # same, regardless of layout and keyboard selected
     with open('/usr/include/X11/keysymdef.h', 'rt') as f:
-        while True:
-            # read until end of file
-            line = f.readline()
-            if len(line) == 0:
-                break
-
-            # look for symbol definitions
-            m = re.match(SYMDEF_PAT, line)
-            if m is None:
-                continue
+        text = f.read()
 
-            # decode the definition; the first group is the symbol name, the
-            # second is the character code, and the third is the unicode of the
-            # code, if defined, otherwise None
-            sym_name = m.group(1)
-            sym_char = int(m.group(2), 16)
-            sym_unic = None if m.group(4) is None else int(m.group(4), 16)
+    # look for symbol definitions
+    for m in SYMDEF_PAT.finditer(text):
+        # decode the definition; the first group is the symbol name, the
+        # second is the character code, and the third is the unicode of the
+        # code, if defined, otherwise None
+        sym_name = m.group(1)
+        sym_char = int(m.group(2), 16)
+        sym_unic = None if m.group(3) is None else int(m.group(3), 16)
 
-            # collect these in the global dictionary
-            sym_map[sym_name] = (sym_char, sym_unic)
+        # collect these in the global dictionary
+        sym_map[sym_name] = (sym_char, sym_unic)
 
     return sym_map
 
@@ -504,58 +711,61 @@ def read_keycode_map(name):
     :return: List that is indexed by scancode, with virtual key name for this
              scancode, or None if not defined
     """
+    # list indexed by the scancode, giving the virtual key code; it is filled
+    # in directly as the definitions are read. the scancode of each virtual key
+    # is only kept to be able to resolve aliases
+    scancode_map = [None]
     key_codes = {}
-    max_key_code = 0
     with open(path.join('/usr/share/X11/xkb/keycodes', name), 'rt') as f:
-        while True:
-            # read until end of file
-            line = f.readline()
-            if len(line) == 0:
-                break
-
+        for line in f:
             # read definition; first group is the name of the keycode,
             # the second group is the scancode.
-            m = re.match(KEYCODE_PAT, line)
+            m = KEYCODE_PAT.match(line)
             if m is not None:
-                virt_key = m.group(1)
+                virt_key = sys.intern(m.group(1))
                 scancode = int(m.group(2))
+                # make room for the largest value seen
+                if scancode >= len(scancode_map):
+                    scancode_map.extend([None] * (scancode + 1 -
+                                                  len(scancode_map)))
                 # if we have already seen the virtual key, then we are past the
                 # initial basic definition and have started on auxiliary
                 # definitions; we don't use those, so skip any redefinitions
                 if virt_key not in key_codes:
+                    log.debug('virt_key = %s, scancode = %d', virt_key,
+                              scancode)
                     key_codes[virt_key] = scancode
-                # keep track of the largest value seen
-                max_key_code = max(max_key_code, scancode)
+                    scancode_map[scancode] = virt_key
                 continue
 
             # if we didn't get a definition, maybe it is an alias
-            m = re.match(ALIAS_PAT, line)
+            m = ALIAS_PAT.match(line)
             if m is not None:
-                key_codes[m.group(1)] = key_codes[m.group(2)]
-
-    # now turn everything inside-out; we want a list indexed by the scancode,
-    # giving the virtual key code
-    scancode_map = [None] * (max_key_code+1)
-    for _, (virt_key, scancode) in enumerate(key_codes.items()):
-        log.debug('virt_key = %s, scancode = %d', virt_key, scancode)
-        scancode_map[scancode] = virt_key
+                virt_key = sys.intern(m.group(1))
+                scancode = key_codes[m.group(2)]
+                log.debug('virt_key = %s, scancode = %d', virt_key, scancode)
+                key_codes[virt_key] = scancode
+                scancode_map[scancode] = virt_key
 
     return scancode_map
 
 
 # modifier combinations that have their own sections in XRDP format
 XRDP_MODS = col.OrderedDict([
-    ('noshift', frozenset()),
-    ('shift', frozenset([Modifier.Shift])),
-    ('altgr', frozenset([Modifier.AltGr])),
-    ('shiftaltgr', frozenset([Modifier.Shift, Modifier.AltGr])),
-    ('capslock', frozenset([Modifier.CapsLock])),
-    ('capslockaltgr', frozenset([Modifier.CapsLock, Modifier.AltGr])),
-    ('shiftcapslock', frozenset([Modifier.Shift, Modifier.CapsLock])),
-    ('shiftcapslockaltgr', frozenset(
-        [Modifier.Shift, Modifier.CapsLock, Modifier.AltGr]))
+    ('noshift', 0),
+    ('shift', Modifier.Shift.value),
+    ('altgr', Modifier.AltGr.value),
+    ('shiftaltgr', Modifier.Shift.value | Modifier.AltGr.value),
+    ('capslock', Modifier.CapsLock.value),
+    ('capslockaltgr', Modifier.CapsLock.value | Modifier.AltGr.value),
+    ('shiftcapslock', Modifier.Shift.value | Modifier.CapsLock.value),
+    ('shiftcapslockaltgr', (Modifier.Shift.value | Modifier.CapsLock.value |
+                            Modifier.AltGr.value)),
 ])
 
+# sections in the order they are written, with the modifiers for each
+XRDP_SECTIONS = tuple(XRDP_MODS.items())
+
 
 def write_xrdp(layout_map, symbol_map, keycode_map, outf):
     """\
@@ -566,45 +776,47 @@ def write_xrdp(layout_map, symbol_map, keycode_map, outf):
     :param keycode_map: Map for scancode to virtual key
     :param outf: File that will receive generated keymap in XRDP format
     """
+    # only generate entries for keycodes that have an associated virtual key
+    # (otherwise it is an unused scancode), and which has something defined
+    # in the layout; this is the same for every section, so find them once
+    defined_keys = [(keycode, virt_key, layout_map[virt_key])
+                    for keycode, virt_key in enumerate(keycode_map)
+                    if virt_key is not None and virt_key in layout_map]
+
     # write each section separately
-    for ndx, section in enumerate(XRDP_MODS):
+    for ndx, (section, mods) in enumerate(XRDP_SECTIONS):
+        # the lines of the section are collected and written all at once
+        buf = []
+
         # section header
-        outf.write("[{0:s}]\n".format(section))
+        buf.append("[{0:s}]\n".format(section))
 
         # key definitions
-        mods = XRDP_MODS[section]
-        for keycode, virt_key in enumerate(keycode_map):
-            # only generate entries for keycodes that have an associated virtual
-            # key (otherwise it is an unused scancode)
-            if virt_key is None:
-                continue
-
-            # if there is nothing defined for this virtual key in the layout,
-            # then just skip it as well
-            if virt_key not in layout_map:
-                continue
-
+        for keycode, virt_key, sym_for_mods in defined_keys:
             # if this combination of virtual key and modifiers doesn't exist,
-            # then drop it
-            if mods not in layout_map[virt_key]:
+            # then drop it; otherwise there is a symbol for this combination,
+            # and we look up the character and possibly printable code, and
+            # generate an entry for it
+            sym = sym_for_mods.get(mods)
+            if sym is None:
                 continue
 
-            # there is a symbol for this combination; look up the character and
-            # possibly printable code, and generate an entry for it
-            sym = layout_map[virt_key][mods]
-
             # if there is no character for this symbol, generate empty entry
             char, unic = symbol_map[sym] if sym in symbol_map else (0, 0)
 
-            # write all the gathered information to file
-            outf.write("Key{0:d}={1:d}:{2:d}\n".format(keycode,
-                0 if char is None else char, 0 if unic is None else unic))
-            log.debug("key = %s, modifier = %s: symbol = %s",
-                      virt_key, ",".join([m.name for m in mods]), chr(char))
+            # add all the gathered information to the section
+            buf.append("Key{0:d}={1:d}:{2:d}\n".format(keycode, char or 0,
+                                                       unic or 0))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("key = %s, modifier = %s: symbol = %s",
+                          virt_key, ",".join(mod_names(mods)),
+                          chr(char))
 
         # newline at end of each section, unless it's the last
-        if ndx < len(XRDP_MODS) - 1:
-            outf.write("\n")
+        if ndx < len(XRDP_SECTIONS) - 1:
+            buf.append("\n")
+
+        outf.write(''.join(buf))
 
 
 def main(args):
@@ -626,6 +838,7 @@ def main(args):
     parser.add_argument("-variant", type=str, required=False)
     parser.add_argument("-option", type=str, action='append')
     parser.add_argument("-options", type=str, nargs="?")
+    parser.add_argument("--no-cache", action="store_true")
     parser.add_argument("--generate", choices = ['xrdp'])
     parser.add_argument("--output", type=str, nargs="?", default='-')
     args = parser.parse_args ()
@@ -645,10 +858,19 @@ def main(args):
         options.extend(args.option)
     if args.options is not None:
         options.extend(args.options.split(','))
-    layout_source = compile_layout(args.layout, args.variant, options)
-
-    # parse the layout definition source file into a data structure
-    layout_map = read_layout_map(layout_source)
+    # the parser doesn't read the compiled source to the end; closing it
+    # lets the programs finish, and raises any error they had, before the
+    # output file is touched
+    try:
+        with contextlib.closing(compile_layout(args.layout, args.variant,
+                                               options,
+                                               not args.no_cache)) as compiled:
+            # parse the layout definition source file into a data structure
+            layout_map = read_layout_map(PushbackIter(compiled))
+    except subprocess.CalledProcessError as err:
+        # the program has already written its own message about why
+        log.fatal("Exit status %d from: %s", err.returncode, " ".join(err.cmd))
+        sys.exit(1)
     symbol_map = read_symbol_map()
 
     try: